@@ -1,11 +1,20 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import pandas as pd
 import numpy as np
+import numba
+from python_calamine import CalamineWorkbook
 
 # --- 頁面設定 ---
 st.set_page_config(page_title="AHP 層級分析系統 V6.0", layout="wide")
 
 # --- 核心數學函式 ---
+# 隨機一致性指標 RI，以矩陣階數 n 直接索引 (_RI[n])
+_RI = np.array([0, 0, 0, 0.58, 0.90, 1.12, 1.24, 1.32, 1.41, 1.45, 1.49, 1.51, 1.48, 1.56, 1.57, 1.59], dtype=np.float64)
+
 def repair_matrix(matrix):
     """
     修復矩陣 (單一專家)：
@@ -13,47 +22,178 @@ def repair_matrix(matrix):
     2. 確保右上角有值 (若無則補1)
     3. 自動計算左下角倒數 (這是關鍵！必須在幾何平均前做)
     """
-    matrix = np.array(matrix, dtype=float)
-    rows, cols = matrix.shape
-    
-    for i in range(rows):
-        for j in range(cols):
-            if i == j: 
-                matrix[i, j] = 1.0
-            elif i < j:
-                # 右上角：如果讀到 0 或 NaN，預設補 1
-                if matrix[i, j] == 0 or np.isnan(matrix[i, j]): 
-                    matrix[i, j] = 1.0
-                # 左下角：強制倒數
-                if matrix[i, j] != 0:
-                    matrix[j, i] = 1.0 / matrix[i, j]
-                else:
-                    matrix[j, i] = 1.0 
+    # 判斷尺度只在 1/9 ~ 9 之間，float32 精度已足夠，頻寬減半
+    matrix = np.array(matrix, dtype=np.float32)
+    n = matrix.shape[0]
+    iu = np.triu_indices(n, 1)
+
+    # 右上角：如果讀到 0 或 NaN，預設補 1
+    upper = matrix[iu]
+    upper = np.where(np.isnan(upper) | (upper == 0), 1.0, upper)
+    matrix[iu] = upper
+    # 左下角：強制倒數 (matrix.T[iu] 即為左下角對應位置)
+    matrix.T[iu] = 1.0 / upper
+    np.fill_diagonal(matrix, 1.0)
     return matrix
 
-def calculate_ahp_weights(matrix):
-    """只計算權重與 CR (不需再修復，因為進來前已經修復過了)"""
-    n = matrix.shape[0]
-    col_sums = matrix.sum(axis=0)
-    with np.errstate(divide='ignore', invalid='ignore'):
-        normalized_matrix = matrix / col_sums
-    weights = normalized_matrix.mean(axis=1)
-    
-    lambda_max = np.dot(col_sums, weights)
-    ci = (lambda_max - n) / (n - 1) if n > 1 else 0
-    ri_table = {1:0, 2:0, 3:0.58, 4:0.90, 5:1.12, 6:1.24, 7:1.32, 8:1.41, 9:1.45, 10:1.49}
-    ri = ri_table.get(n, 1.49)
-    cr = ci / ri if n > 2 else 0
-    return weights, cr
-
-def geometric_mean_matrix(matrices):
-    """多專家幾何平均"""
-    if not matrices: return None
-    stack = np.array(matrices)
-    # 這裡因為傳進來的 matrices 都已經被 repair 過了，所以不會有 0
-    prod = np.prod(stack, axis=0)
-    geo_mean = np.power(prod, 1/len(matrices))
-    return geo_mean
+def sheet_to_matrix(rows):
+    """
+    將工作表儲存格轉成數值矩陣：
+    1. 非數值的儲存格 (標題、空白) 視為 NaN
+    2. 去除整列或整欄皆為 NaN 的部分
+    """
+    width = max((len(row) for row in rows), default=0)
+    matrix = np.full((len(rows), width), np.nan, dtype=np.float32)
+    for i, row in enumerate(rows):
+        try:
+            matrix[i, :len(row)] = row
+        except (TypeError, ValueError):
+            # 這一列夾雜文字或空白，逐格轉換
+            for j, value in enumerate(row):
+                try:
+                    matrix[i, j] = value
+                except (TypeError, ValueError):
+                    pass
+    empty = np.isnan(matrix)
+    return matrix[~empty.all(axis=1)][:, ~empty.all(axis=0)]
+
+@st.cache_resource
+def _ahp_kernel():
+    """
+    編譯多專家 AHP 核心：對 (專家數, n, n) 的堆疊一次完成
+    幾何平均矩陣、欄總和、列幾何平均權重與 lambda_max。
+    放在 cache_resource 裡，每個程序只編譯一次，Streamlit rerun 不會重新 JIT。
+    """
+    @numba.njit(fastmath=True, error_model="numpy")
+    def kernel(stack):
+        k, n, _ = stack.shape
+        geo_mean = np.empty((n, n), dtype=stack.dtype)
+        col_sums = np.zeros(n, dtype=stack.dtype)
+        weights = np.empty(n, dtype=stack.dtype)
+        # 倒數指數提到迴圈外，迴圈內只做乘法
+        inv_k = 1.0 / k
+        inv_n = 1.0 / n
+        for i in range(n):
+            row_log_sum = 0.0
+            for j in range(n):
+                log_sum = 0.0
+                for e in range(k):
+                    log_sum += np.log(stack[e, i, j])
+                log_mean = log_sum * inv_k
+                geo_mean[i, j] = np.exp(log_mean)
+                col_sums[j] += geo_mean[i, j]
+                # log(幾何平均矩陣) 已經算好，直接累加成列幾何平均
+                row_log_sum += log_mean
+            weights[i] = np.exp(row_log_sum * inv_n)
+        weights /= weights.sum()
+        lambda_max = 0.0
+        for j in range(n):
+            lambda_max += col_sums[j] * weights[j]
+        return geo_mean, weights, lambda_max
+
+    kernel(np.ones((1, 2, 2), dtype=np.float32))  # 預熱：先用 1 位專家的 2x2 觸發編譯
+    return kernel
+
+def aggregate_ahp(stack):
+    """
+    多專家整合：幾何平均矩陣、權重與 CR 一次算完
+    stack 形狀為 (專家數, n, n)，且都已經 repair 過了，所以不會有 0
+    """
+    final_matrix, weights, lambda_max = _ahp_kernel()(stack)
+    return final_matrix, weights, float(consistency_ratio(lambda_max, stack.shape[1]))
+
+def calculate_expert_weights(stack):
+    """
+    批次計算每位專家的權重與 CR：
+    stack 形狀為 (專家數, n, n)，一次向量化運算，不必逐位專家呼叫
+    """
+    n = stack.shape[1]
+    col_sums = stack.sum(axis=1)
+    weights = np.exp(np.log(stack).mean(axis=2))
+    weights /= weights.sum(axis=1, keepdims=True)
+    lambda_max = np.einsum('ki,ki->k', col_sums, weights)
+    return weights, consistency_ratio(lambda_max, n)
+
+def consistency_ratio(lambda_max, n):
+    """由 lambda_max 計算 CR (lambda_max 可為單一數值，或多位專家的陣列)"""
+    if n <= 2:
+        # 1、2 階矩陣必定一致
+        return lambda_max * 0.0
+    ci = (lambda_max - n) / (n - 1)
+    ri = _RI[n] if n < _RI.size else 1.49
+    return ci / ri
+
+# --- 顯示輔助 ---
+def blues_gradient(values):
+    """
+    藍色漸層背景 (取代 background_gradient(cmap="Blues")，免載入 Matplotlib)：
+    最小值為淺藍、最大值為深藍，深色底改用白字
+    """
+    values = np.asarray(values, dtype=float)
+    span = values.max() - values.min()
+    t = (values - values.min()) / span if span > 0 else np.zeros_like(values)
+    light, dark = np.array([247, 251, 255]), np.array([8, 48, 107])
+    rgb = (light + np.outer(t, dark - light)).round().astype(int)
+    return [
+        f"background-color: rgb({r}, {g}, {b}); color: {'white' if level > 0.5 else 'black'}"
+        for (r, g, b), level in zip(rgb, t)
+    ]
+
+# --- 資料讀取 ---
+def read_expert_matrix(workbook, sheet, manual_n):
+    """讀取單一專家的工作表並修復矩陣；格式異常則回傳 None"""
+    # 1. 讀取 (直接轉成數值矩陣，不經過 DataFrame)
+    worksheet = workbook.get_sheet_by_name(sheet)
+    # 使用範圍連 2x2 都不到，不可能組成比較矩陣，不必轉換儲存格
+    if min(worksheet.height, worksheet.width) < 2:
+        return None
+    raw_matrix = sheet_to_matrix(worksheet.to_python(skip_empty_area=True))
+
+    # 2. 裁切
+    if manual_n > 0:
+        if raw_matrix.shape[0] >= manual_n and raw_matrix.shape[1] >= manual_n:
+            raw_matrix = raw_matrix[:manual_n, :manual_n]
+
+    rows, cols = raw_matrix.shape
+
+    if rows == cols and rows > 1:
+        # 3. 【關鍵修正】先修復矩陣 (填補 0)，才加入列表
+        return repair_matrix(raw_matrix)
+    return None
+
+@st.cache_data
+def load_and_repair(file_bytes, manual_n):
+    """
+    讀取所有專家的工作表並修復矩陣 (各工作表平行處理)。
+    以檔案內容與 N 作為快取鍵，操作其他元件觸發 rerun 時不必重新解析 Excel。
+    回傳 (工作表名稱, 修復後矩陣列表, 格式異常而略過的工作表)
+    """
+    # 所有活頁簿都由同一份 bytes 快照開啟 (BytesIO 不會複製內容)
+    workbook = CalamineWorkbook.from_object(io.BytesIO(file_bytes))
+    sheet_names = workbook.sheet_names
+    # 讀工作表名稱時開啟的活頁簿交給第一個執行緒沿用，不必重新解析
+    spare_workbooks = [workbook]
+    local = threading.local()
+
+    def process_sheet(sheet):
+        # CalamineWorkbook 不能跨執行緒同時使用，每個執行緒各持一份 (只開一次)
+        if not hasattr(local, "workbook"):
+            try:
+                local.workbook = spare_workbooks.pop()
+            except IndexError:
+                local.workbook = CalamineWorkbook.from_object(io.BytesIO(file_bytes))
+        return read_expert_matrix(local.workbook, sheet, manual_n)
+
+    # 執行緒內不呼叫任何 st.* 元件，只傳遞矩陣與工作表名稱
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(sheet_names)))) as executor:
+        results = list(executor.map(process_sheet, sheet_names))
+
+    valid_matrices = [matrix for matrix in results if matrix is not None]
+    skipped_sheets = [sheet for sheet, matrix in zip(sheet_names, results) if matrix is None]
+    return sheet_names, valid_matrices, skipped_sheets
+
+# 啟動時先完成 JIT 編譯，避免第一次上傳檔案時才卡住
+_ahp_kernel()
 
 # --- 主程式介面 ---
 
@@ -77,39 +217,19 @@ with tab1:
     with col2:
         if uploaded_file is not None:
             try:
-                excel_file = pd.ExcelFile(uploaded_file)
-                sheet_names = excel_file.sheet_names
-                valid_matrices = []
-                
-                st.write(f"📄 偵測到 {len(sheet_names)} 位專家資料")
+                # 上傳檔只讀取一次，這份 bytes 同時作為快取鍵
+                file_bytes = uploaded_file.getvalue()
+                sheet_names, valid_matrices, skipped_sheets = load_and_repair(file_bytes, manual_n)
 
-                for sheet in sheet_names:
-                    # 1. 讀取
-                    df = pd.read_excel(uploaded_file, sheet_name=sheet, header=None)
-                    df = df.apply(pd.to_numeric, errors='coerce')
-                    df_clean = df.dropna(how='all').dropna(axis=1, how='all')
-                    raw_matrix = df_clean.values
-                    
-                    # 2. 裁切
-                    if manual_n > 0:
-                        if raw_matrix.shape[0] >= manual_n and raw_matrix.shape[1] >= manual_n:
-                            raw_matrix = raw_matrix[:manual_n, :manual_n]
-                    
-                    rows, cols = raw_matrix.shape
-                    
-                    if rows == cols and rows > 1:
-                        # 3. 【關鍵修正】先修復矩陣 (填補 0)，才加入列表
-                        repaired_matrix = repair_matrix(raw_matrix)
-                        valid_matrices.append(repaired_matrix)
-                    else:
-                        st.warning(f"⚠️ 工作表 {sheet} 格式異常，已略過。")
+                st.write(f"📄 偵測到 {len(sheet_names)} 位專家資料")
+                for sheet in skipped_sheets:
+                    st.warning(f"⚠️ 工作表 {sheet} 格式異常，已略過。")
 
                 if valid_matrices:
-                    # 4. 幾何平均整合
-                    final_matrix = geometric_mean_matrix(valid_matrices)
-                    
-                    # 5. 計算最終權重
-                    weights, cr = calculate_ahp_weights(final_matrix)
+                    stack = np.stack(valid_matrices)
+
+                    # 4. 幾何平均整合 + 5. 計算最終權重 (同一個 JIT 核心完成)
+                    final_matrix, weights, cr = aggregate_ahp(stack)
                     
                     st.success("✅ 計算完成！")
                     
@@ -117,6 +237,17 @@ with tab1:
                     with st.expander("👀 查看整合後的矩陣 (幾何平均)", expanded=False):
                         st.dataframe(pd.DataFrame(final_matrix))
 
+                    # 各專家個別的一致性 (整批一次計算)
+                    expert_names = [sheet for sheet in sheet_names if sheet not in skipped_sheets]
+                    _, expert_cr = calculate_expert_weights(stack)
+                    with st.expander("🧑‍🏫 查看各專家 CR 值", expanded=False):
+                        df_cr = pd.DataFrame({
+                            "專家": expert_names,
+                            "CR": expert_cr,
+                            "判定": np.where(expert_cr < 0.1, "合格", "不一致")
+                        })
+                        st.dataframe(df_cr.style.format({"CR": "{:.4f}"}))
+
                     # 結果顯示
                     res_col1, res_col2 = st.columns(2)
                     with res_col1:
@@ -128,12 +259,8 @@ with tab1:
                         "權重": weights
                     })
                     
-                    # 這裡使用安全的顯示方式，避免 Matplotlib 錯誤
-                    try:
-                        st.dataframe(df_res.style.format({"權重": "{:.2%}"}).background_gradient(cmap="Blues"))
-                    except:
-                        # 萬一還是缺套件，就顯示純文字表格
-                        st.dataframe(df_res.style.format({"權重": "{:.2%}"}))
+                    # 漸層由 NumPy 計算，不需要 Matplotlib
+                    st.dataframe(df_res.style.format({"權重": "{:.2%}"}).apply(blues_gradient, subset=["權重"]))
                     
                     st.caption("請複製此處權重，填入 Step 2 進行整合。")
 
@@ -154,11 +281,14 @@ with tab2:
     edited_df = st.data_editor(st.session_state.grid_data, num_rows="dynamic", use_container_width=True)
 
     if st.button("計算最終排名"):
-        res = edited_df.copy()
-        res["構面權重"] = pd.to_numeric(res["構面權重"], errors='coerce').fillna(0)
-        res["準則局部權重"] = pd.to_numeric(res["準則局部權重"], errors='coerce').fillna(0)
-        res["全球權重"] = res["構面權重"] * res["準則局部權重"]
-        res = res.sort_values("全球權重", ascending=False).reset_index(drop=True)
+        # 取出成 NumPy 陣列再相乘、排序，省去 pandas 的索引對齊
+        dim_w = pd.to_numeric(edited_df["構面權重"], errors='coerce').to_numpy(dtype=float, na_value=0.0)
+        crit_w = pd.to_numeric(edited_df["準則局部權重"], errors='coerce').to_numpy(dtype=float, na_value=0.0)
+        global_w = dim_w * crit_w
+        order = np.argsort(-global_w, kind="stable")
+        res = edited_df.iloc[order].assign(
+            構面權重=dim_w[order], 準則局部權重=crit_w[order], 全球權重=global_w[order]
+        ).reset_index(drop=True)
         st.dataframe(res.style.format({
             "構面權重": "{:.2%}", "準則局部權重": "{:.2%}", "全球權重": "{:.2%}"
         }))